@@ -10,25 +10,55 @@ import os
 import re
 import json
 import difflib
+import heapq
 import webbrowser
 import random
 import time
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
+from functools import lru_cache
+from itertools import count
 
 try:
     import nltk
     from nltk.corpus import wordnet
-    nltk.download('wordnet', quiet=True)
-    nltk.download('omw-1.4', quiet=True)
+    # Only hit the downloader when a corpus is actually missing
+    for corpus in ('wordnet', 'omw-1.4'):
+        try:
+            nltk.data.find(f'corpora/{corpus}')
+        except LookupError:
+            nltk.download(corpus, quiet=True)
     HAS_NLTK = True
 except ImportError:
     HAS_NLTK = False
 
+try:
+    from rapidfuzz import fuzz, process as rf_process
+    HAS_RAPIDFUZZ = True
+except ImportError:
+    HAS_RAPIDFUZZ = False
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    import ahocorasick
+    HAS_AHOCORASICK = True
+except ImportError:
+    HAS_AHOCORASICK = False
+
 class Config:
     AGENT_NAME = "Isaac"
     USER_NAME = "User"
     MODULE_PRIORITY_BOOST = 3.0
     UNIQUE_WORD_BONUS = 1.8
+    MAX_LOADED_MODULES = 32
+    SELECTION_CACHE_SIZE = 256
+    RECENT_COMMAND_LIMIT = 5
+    FUZZY_MATCH_CUTOFF = 75
     
     ACTION_VERBS = {
         "open", "close", "search", "find", "look", "get", "take", 
@@ -41,6 +71,102 @@ class Config:
         "time", "date", "help", "joke"
     }
 
+_WORD_RE = re.compile(r'\b\w+\b')
+
+# For ASCII text, \w is exactly [A-Za-z0-9_]; blanking everything else turns
+# word extraction into one translate() and split()
+_ASCII_NON_WORD = str.maketrans({
+    chr(c): " " for c in range(128)
+    if not (chr(c).isalnum() or chr(c) == "_")
+})
+_PLACEHOLDER_RE = re.compile(r'(\{(?:subject|name|username)\})')
+
+def _py_import(name, *args, **kwargs):
+    # datetime.strftime imports time internally, so allow only the modules
+    # py: commands can already reach
+    if name not in ("datetime", "random", "time"):
+        raise ImportError(f"Import of '{name}' is not allowed in commands")
+    return __import__(name, *args, **kwargs)
+
+# Namespace for py: commands; subject is passed per call as a local
+_PY_GLOBALS = {
+    "datetime": datetime,
+    "random": random,
+    "time": time,
+    "__builtins__": {"__import__": _py_import}
+}
+
+# Built-in call: commands; each takes the extracted subject
+_COMMANDS = {
+    "time_now": lambda subject: datetime.now().strftime('%H:%M'),
+    "date_today": lambda subject: datetime.now().strftime('%A, %B %d, %Y'),
+    "random_number": lambda subject: random.randint(1, 100),
+    "roll_die": lambda subject: random.randint(1, 6),
+    "flip_coin": lambda subject: 'Heads' if random.randint(0, 1) == 0 else 'Tails',
+}
+
+# Lazy stem keeps at least 3 characters and prefers the longest suffix,
+# matching the old ordered endswith() loop in a single C-level call
+_SUFFIX_RE = re.compile(r'(.{3,}?)(?:ing|est|ly|ed|es|er|s)', re.DOTALL)
+
+def _response_template(text):
+    """Escape literal braces so only known placeholders survive str.format_map"""
+    parts = _PLACEHOLDER_RE.split(text)
+    for i in range(0, len(parts), 2):
+        parts[i] = parts[i].replace("{", "{{").replace("}", "}}")
+    
+    return "".join(parts)
+
+def _load_json(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    
+    return orjson.loads(data) if HAS_ORJSON else json.loads(data)
+
+@lru_cache(maxsize=8192)
+def _stem(word):
+    if len(word) <= 3:
+        return word
+    
+    match = _SUFFIX_RE.fullmatch(word)
+    return match.group(1) if match else word
+
+_ACTION_VERB_STEMS = frozenset(_stem(verb) for verb in Config.ACTION_VERBS)
+
+def _find_action_verb(words):
+    for word in words:
+        word_stem = _stem(word)
+        if word_stem in _ACTION_VERB_STEMS:
+            return word_stem
+    
+    return None
+
+@lru_cache(maxsize=1024)
+def _tokenize(text):
+    text = text.lower()
+    if text.isascii():
+        words = text.translate(_ASCII_NON_WORD).split()
+    else:
+        words = _WORD_RE.findall(text)
+    meaningful_words = tuple(w for w in words if len(w) > 1)
+    
+    return meaningful_words, _find_action_verb(words)
+
+@lru_cache(maxsize=2048)
+def _synonyms(word):
+    """Get WordNet synonyms for a word as an immutable, ordered tuple"""
+    if not HAS_NLTK:
+        return ()
+    
+    synonyms = {}
+    for synset in wordnet.synsets(word):
+        for lemma in synset.lemmas():
+            synonym = lemma.name().lower().replace('_', ' ')
+            if synonym != word:
+                synonyms[synonym] = None
+    
+    return tuple(synonyms)
+
 class IsaacCore:
     def __init__(self, brain_dir, agent_name=None, user_name=None):
         self.brain_dir = brain_dir
@@ -49,8 +175,20 @@ class IsaacCore:
         
         self.core_knowledge = []
         self.module_bridge = {}
-        self.loaded_modules = {}
-        self.recent_command_ids = []
+        self._word_bridge = {}
+        self._phrase_bridge = {}
+        self._bridge_automaton = None
+        self.loaded_modules = OrderedDict()
+        self._module_mtimes = {}
+        self.stem_index = defaultdict(list)
+        self._entry_ids = count()
+        self._source_vocab = {}
+        self._valid_tokens_cache = {}
+        self._compiled_cmds = {}
+        self._cmd_registry = dict(_COMMANDS)
+        self._selection_cache = OrderedDict()
+        self.recent_command_ids = deque(maxlen=Config.RECENT_COMMAND_LIMIT)
+        self._recent_set = set()
         
         self.global_data_file = os.path.join(brain_dir, "basedata.json")
         self.bridge_data_file = os.path.join(brain_dir, "bridgedata.json")
@@ -66,98 +204,200 @@ class IsaacCore:
             raise FileNotFoundError(f"Base knowledge file not found: {self.global_data_file}")
         
         try:
-            with open(self.global_data_file, 'r', encoding='utf-8') as f:
-                self.core_knowledge = json.load(f)
+            core_knowledge = _load_json(self.global_data_file)
         except Exception as e:
             raise Exception(f"Error loading core knowledge: {e}")
+        
+        # Reloading replaces the previous core entries everywhere they are cached
+        self.drop_postings(self.core_knowledge, None)
+        self._valid_tokens_cache.clear()
+        self._selection_cache.clear()
+        
+        self.core_knowledge = core_knowledge
+        self.prepare_entries(self.core_knowledge)
+        self.index_entries(self.core_knowledge)
+    
+    def prepare_entries(self, entries, module_file=None):
+        """Normalize entry tokens, precompute their stems and tag the source module"""
+        vocab = set()
+        for position, entry in enumerate(entries):
+            tokens = entry.get("tokens")
+            if isinstance(tokens, str):
+                tokens = [tokens]
+            elif tokens is None:
+                tokens = []
+            
+            entry["tokens"] = tokens
+            
+            # Map each stem to the first token producing it, for reporting matches
+            stem_tokens = {}
+            for token in tokens:
+                token_lower = token.lower()
+                vocab.add(token_lower)
+                stem_tokens.setdefault(_stem(token_lower), token)
+            
+            entry["_stem_tokens"] = stem_tokens
+            entry["_stem_set"] = frozenset(stem_tokens)
+            entry["_module"] = module_file
+            entry["_pos"] = position
+            entry["_id"] = next(self._entry_ids)
+            
+            resp = entry.get("resp")
+            if resp is None:
+                resp = "I'm not sure how to respond."
+            entry["_resp_template"] = _response_template(resp)
+        
+        # Lowercased vocabulary of this source, for synonym and fuzzy correction
+        self._source_vocab[module_file] = frozenset(vocab)
+    
+    def index_entries(self, entries):
+        """Add prepared entries to the stem index"""
+        for entry in entries:
+            for token_stem in entry["_stem_set"]:
+                self.stem_index[token_stem].append(entry)
     
     def load_bridge_data(self):
         if not os.path.exists(self.bridge_data_file):
             return
         
         try:
-            with open(self.bridge_data_file, 'r', encoding='utf-8') as f:
-                bridges = json.load(f)
+            bridges = _load_json(self.bridge_data_file)
             
             for bridge in bridges:
                 keywords = bridge.get("keywords", [])
                 module_file = bridge.get("module", "")
                 
-                if module_file:
-                    module_path = os.path.join(self.brain_dir, module_file)
-                    if os.path.exists(module_path):
-                        for keyword in keywords:
-                            self.module_bridge[keyword.lower()] = module_file
+                if module_file and os.path.exists(os.path.join(self.brain_dir, module_file)):
+                    for keyword in keywords:
+                        self.module_bridge[keyword.lower()] = module_file
+            
+            # Plain words are looked up against the query tokens; anything
+            # else (phrases, symbols, single letters) is matched in the text
+            for order, (keyword, module_file) in enumerate(self.module_bridge.items()):
+                if len(keyword) > 1 and _WORD_RE.fullmatch(keyword):
+                    self._word_bridge[keyword] = (order, module_file)
+                else:
+                    self._phrase_bridge[keyword] = (order, module_file)
+            
+            # One automaton matches every phrase keyword in a single pass
+            if HAS_AHOCORASICK and self._phrase_bridge:
+                automaton = ahocorasick.Automaton()
+                for keyword, value in self._phrase_bridge.items():
+                    automaton.add_word(keyword, value)
+                automaton.make_automaton()
+                self._bridge_automaton = automaton
         except Exception as e:
             print(f"Warning: Error loading bridge data: {e}")
     
-    def load_module(self, module_filename):
-        if module_filename in self.loaded_modules:
-            return self.loaded_modules[module_filename]
+    def find_bridged_modules(self, user_tokens, text_lowercase):
+        """Get module files whose bridge keywords appear in the query, in bridge order"""
+        hits = {self._word_bridge[w] for w in user_tokens if w in self._word_bridge}
+        
+        if self._bridge_automaton is not None:
+            hits.update(value for _, value in self._bridge_automaton.iter(text_lowercase))
+        else:
+            hits.update(
+                value for keyword, value in self._phrase_bridge.items()
+                if keyword in text_lowercase
+            )
         
+        return list(dict.fromkeys(module_file for _, module_file in sorted(hits)))
+    
+    def load_module(self, module_filename, keep=()):
+        """Get a module's entries, loading it if needed; modules in keep are never evicted"""
         module_path = os.path.join(self.brain_dir, module_filename)
-        if not os.path.exists(module_path):
+        try:
+            mtime = os.stat(module_path).st_mtime_ns
+        except OSError:
+            self.unload_module(module_filename)
             return []
         
+        if module_filename in self.loaded_modules:
+            if self._module_mtimes[module_filename] == mtime:
+                self.loaded_modules.move_to_end(module_filename)
+                return self.loaded_modules[module_filename]
+            
+            # File changed on disk since it was cached
+            self.unload_module(module_filename)
+        
         try:
-            with open(module_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = _load_json(module_path)
             
             if isinstance(data, list):
+                self.prepare_entries(data, module_filename)
+                self.index_entries(data)
                 self.loaded_modules[module_filename] = data
+                self._module_mtimes[module_filename] = mtime
+                self._valid_tokens_cache.clear()
+                self._selection_cache.clear()
+                
+                # Modules already bridged by the current query stay indexed,
+                # so the cache may run over until the next load
+                while len(self.loaded_modules) > Config.MAX_LOADED_MODULES:
+                    evicted = next(
+                        (m for m in self.loaded_modules if m != module_filename and m not in keep),
+                        None
+                    )
+                    if evicted is None:
+                        break
+                    self.unload_module(evicted)
+                
                 return data
         except Exception as e:
             print(f"Warning: Error loading module {module_filename}: {e}")
         
         return []
     
-    def tokenize(self, text):
-        words = re.findall(r'\b\w+\b', text.lower())
-        
-        action_verb = None
-        for word in words:
-            if word in Config.ACTION_VERBS:
-                action_verb = word
-                break
+    def unload_module(self, module_filename):
+        """Drop a cached module and its stem index postings"""
+        data = self.loaded_modules.pop(module_filename, None)
+        if data is None:
+            return
         
-        meaningful_words = [w for w in words if len(w) > 1]
+        del self._module_mtimes[module_filename]
+        self._source_vocab.pop(module_filename, None)
+        self._valid_tokens_cache.clear()
+        self._selection_cache.clear()
         
-        return meaningful_words, action_verb
+        self.drop_postings(data, module_filename)
+    
+    def drop_postings(self, entries, module_file):
+        """Remove a source's entries from the stem index"""
+        for entry in entries:
+            for token_stem in entry["_stem_set"]:
+                postings = self.stem_index.get(token_stem)
+                if postings is None:
+                    continue
+                
+                postings = [p for p in postings if p["_module"] != module_file]
+                if postings:
+                    self.stem_index[token_stem] = postings
+                else:
+                    del self.stem_index[token_stem]
+    
+    def tokenize(self, text):
+        meaningful_words, action_verb_stem = _tokenize(text)
+        return list(meaningful_words), action_verb_stem
     
     def stem(self, word):
-        if len(word) <= 3:
-            return word
-        
-        for suffix in ['ing', 'ly', 'ed', 'es', 's', 'er', 'est']:
-            if word.endswith(suffix) and len(word) > len(suffix) + 2:
-                return word[:-len(suffix)]
-        
-        return word
+        return _stem(word)
     
     def get_synonyms(self, word):
         """Get synonyms for a word using WordNet"""
-        if not HAS_NLTK:
-            return []
-        
-        synonyms = []
-        for synset in wordnet.synsets(word):
-            for lemma in synset.lemmas():
-                synonym = lemma.name().lower().replace('_', ' ')
-                if synonym != word:
-                    synonyms.append(synonym)
-        
-        return synonyms
+        return list(_synonyms(word))
     
-    def extract_subject(self, user_tokens, matched_tokens):
+    def extract_subject(self, user_tokens, matched_tokens, last_match_index=None):
         if not matched_tokens or not user_tokens:
             return "that"
         
-        last_match_index = -1
-        for token in matched_tokens:
-            token_stem = self.stem(token)
-            for i, user_word in enumerate(user_tokens):
-                if self.stem(user_word) == token_stem:
-                    last_match_index = max(last_match_index, i)
+        # Scoring already knows the last matched position; rescan otherwise
+        if last_match_index is None:
+            last_match_index = -1
+            for token in matched_tokens:
+                token_stem = _stem(token)
+                for i, user_word in enumerate(user_tokens):
+                    if _stem(user_word) == token_stem:
+                        last_match_index = max(last_match_index, i)
         
         if last_match_index >= 0 and last_match_index < len(user_tokens) - 1:
             subject_words = user_tokens[last_match_index + 1:]
@@ -165,169 +405,261 @@ class IsaacCore:
         
         return "that"
     
-    def score_entry(self, user_tokens, entry, is_module, action_verb, word_usage_map):
-        entry_tokens = entry.get("tokens", [])
-        if isinstance(entry_tokens, str):
-            entry_tokens = [entry_tokens]
-        
+    def score_entry(self, user_tokens, entry, is_module, action_verb_stem, word_usage_map, user_stems=None,
+                    best_score_so_far=0):
         match_count = 0
         matched_tokens = []
+        last_match_index = -1
         verb_bonus = 0
         unique_bonus = 1.0
         
-        if action_verb:
-            for token in entry_tokens:
-                if self.stem(action_verb) == self.stem(token):
-                    verb_bonus = 0.5
-                    break
+        if action_verb_stem and action_verb_stem in entry["_stem_set"]:
+            verb_bonus = 0.5
+        
+        priority = entry.get("val", 1.0)
+        module_boost = Config.MODULE_PRIORITY_BOOST if is_module else 1.0
         
-        for user_word in user_tokens:
-            user_stem = self.stem(user_word)
+        # Highest score still reachable per match, used to prune hopeless entries
+        bound_weight = priority * module_boost * (1.0 + verb_bonus) * max(1.0, Config.UNIQUE_WORD_BONUS)
+        
+        if user_stems is None:
+            user_stems = {w: _stem(w) for w in user_tokens}
+        
+        stem_tokens = entry["_stem_tokens"]
+        remaining = len(user_tokens)
+        for i, user_word in enumerate(user_tokens):
+            user_stem = user_stems[user_word]
+            remaining -= 1
             
-            for token in entry_tokens:
-                token_stem = self.stem(token)
+            if user_stem in stem_tokens:
+                match_count += 1
+                matched_tokens.append(stem_tokens[user_stem])
+                last_match_index = i
                 
-                if user_stem == token_stem:
-                    match_count += 1
-                    matched_tokens.append(token)
-                    
-                    if word_usage_map and word_usage_map.get(user_word) == 1:
-                        unique_bonus = Config.UNIQUE_WORD_BONUS
-                    break
+                if word_usage_map and word_usage_map.get(user_word) == 1:
+                    unique_bonus = Config.UNIQUE_WORD_BONUS
+            
+            if best_score_so_far > 0 and (match_count + remaining) * bound_weight < best_score_so_far:
+                return 0, [], -1
         
         if match_count == 0:
-            return 0, []
-        
-        priority = entry.get("val", 1.0)
-        module_boost = Config.MODULE_PRIORITY_BOOST if is_module else 1.0
+            return 0, [], -1
         
         final_score = match_count * priority * module_boost * (1.0 + verb_bonus) * unique_bonus
         
-        return final_score, matched_tokens
+        return final_score, matched_tokens, last_match_index
     
-    def find_synonym_matches(self, word, all_valid_tokens):
+    def find_synonym_matches(self, word, all_valid_tokens, valid_stems=None):
         """Find token matches using synonyms"""
-        synonyms = self.get_synonyms(word)
-        
-        for synonym in synonyms:
-            synonym_stem = self.stem(synonym)
+        if valid_stems is None:
+            valid_stems = {}
             for valid_token in all_valid_tokens:
-                if synonym_stem == self.stem(valid_token):
-                    return valid_token
+                valid_stems.setdefault(_stem(valid_token), valid_token)
+        
+        for synonym in _synonyms(word):
+            valid_token = valid_stems.get(_stem(synonym))
+            if valid_token is not None:
+                return valid_token
         
         # Fallback to fuzzy string matching
-        matches = difflib.get_close_matches(word, all_valid_tokens, n=1, cutoff=0.75)
+        if HAS_RAPIDFUZZ:
+            match = rf_process.extractOne(word, all_valid_tokens, scorer=fuzz.ratio, score_cutoff=Config.FUZZY_MATCH_CUTOFF)
+            return match[0] if match else None
+        
+        matches = difflib.get_close_matches(word, all_valid_tokens, n=1, cutoff=Config.FUZZY_MATCH_CUTOFF / 100)
         return matches[0] if matches else None
     
-    def process(self, text):
-        user_tokens, action_verb = self.tokenize(text)
-        text_lowercase = text.lower()
-        
-        if not user_tokens:
-            return f"I'm sorry {self.username}, I didn't catch that."
-        
-        # Build knowledge pool from core + dynamic modules
-        knowledge_pool = []
-        
-        for entry in self.core_knowledge:
-            knowledge_pool.append((entry, False))
-        
-        loaded_module_names = set()
-        for keyword, module_file in self.module_bridge.items():
-            if keyword in text_lowercase:
-                module_data = self.load_module(module_file)
-                if module_data and module_file not in loaded_module_names:
-                    loaded_module_names.add(module_file)
-                    for entry in module_data:
-                        knowledge_pool.append((entry, True))
-        
-        # Build word usage map for unique word detection
-        word_usage_map = {}
-        for user_word in user_tokens:
-            user_stem = self.stem(user_word)
+    def _score_with_tokens(self, user_tokens, action_verb_stem, active_modules, word_usage_map, candidates):
+        # Fill the word usage map and candidates from the stem index,
+        # skipping words already counted against this pool
+        user_stems = {w: _stem(w) for w in user_tokens}
+        for user_word, user_stem in user_stems.items():
+            if user_word in word_usage_map:
+                continue
+            
             usage_count = 0
             
-            for entry, _ in knowledge_pool:
-                entry_tokens = entry.get("tokens", [])
-                if isinstance(entry_tokens, str):
-                    entry_tokens = [entry_tokens]
-                
-                for token in entry_tokens:
-                    if user_stem == self.stem(token):
-                        usage_count += 1
-                        break
+            for entry in self.stem_index.get(user_stem, ()):
+                module_file = entry["_module"]
+                if module_file is None or module_file in active_modules:
+                    usage_count += 1
+                    candidates[entry["_id"]] = entry
             
             word_usage_map[user_word] = usage_count
         
-        # Score all entries
+        # Score candidates in pool order (core first, then modules as bridged)
+        # so ties resolve as before. Entries that cannot beat the best
+        # non-recent score can never be picked, so they are pruned early.
+        module_rank = {module_file: rank for rank, module_file in enumerate(active_modules, 1)}
+        ordered_candidates = sorted(
+            candidates.values(),
+            key=lambda e: (module_rank.get(e["_module"], 0), e["_pos"])
+        )
+        
         scored_results = []
+        best_fresh_score = 0
         
-        for entry, is_module in knowledge_pool:
-            score, matched_tokens = self.score_entry(
-                user_tokens, entry, is_module, action_verb, word_usage_map
+        for entry in ordered_candidates:
+            is_module = entry["_module"] is not None
+            score, matched_tokens, last_match_index = self.score_entry(
+                user_tokens, entry, is_module, action_verb_stem, word_usage_map, user_stems,
+                best_fresh_score
             )
             
+            if score > best_fresh_score and entry["_id"] not in self._recent_set:
+                best_fresh_score = score
+            
             if score > 0:
                 scored_results.append({
                     'score': score,
                     'entry': entry,
                     'matched_tokens': matched_tokens,
+                    'last_match_index': last_match_index,
                     'is_module': is_module
                 })
         
-        # If no direct matches, try synonym expansion
-        if not scored_results:
-            all_valid_tokens = set()
-            for entry, _ in knowledge_pool:
-                tokens = entry.get("tokens", [])
-                if isinstance(tokens, str):
-                    all_valid_tokens.add(tokens.lower())
-                else:
-                    for t in tokens:
-                        all_valid_tokens.add(t.lower())
+        return scored_results
+    
+    def process(self, text):
+        user_tokens, action_verb_stem = _tokenize(text)
+        text_lowercase = text.lower()
+        
+        if not user_tokens:
+            return f"I'm sorry {self.username}, I didn't catch that."
+        
+        # Knowledge pool is core + dynamic modules, in bridge order
+        active_modules = {}
+        for module_file in self.find_bridged_modules(user_tokens, text_lowercase):
+            module_data = self.load_module(module_file, active_modules)
+            if module_data:
+                active_modules[module_file] = module_data
+        
+        # Queries that reach a single entry always pick it, whatever was
+        # said recently, so their selection can be reused
+        selection_key = (user_tokens, frozenset(active_modules))
+        cached = self._selection_cache.get(selection_key)
+        if cached is not None:
+            self._selection_cache.move_to_end(selection_key)
+            entry, subject = cached
+            self.remember_command(entry["_id"])
+            return self.respond(entry, subject)
+        
+        return self._process_tokens(
+            user_tokens, action_verb_stem, active_modules, selection_key=selection_key
+        )
+    
+    def get_valid_tokens(self, active_modules):
+        """Get the sorted vocabulary of the pool and a stem -> token map for it"""
+        cache_key = frozenset(active_modules)
+        cached_tokens = self._valid_tokens_cache.get(cache_key)
+        if cached_tokens is None:
+            token_set = self._source_vocab[None].union(
+                *(self._source_vocab.get(module_file, ()) for module_file in active_modules)
+            )
+            
+            all_valid_tokens = tuple(sorted(token_set))
+            valid_stems = {}
+            for valid_token in all_valid_tokens:
+                valid_stems.setdefault(_stem(valid_token), valid_token)
+            
+            cached_tokens = (all_valid_tokens, valid_stems)
+            self._valid_tokens_cache[cache_key] = cached_tokens
+        
+        return cached_tokens
+    
+    def _process_tokens(self, user_tokens, action_verb_stem, active_modules, selection_key=None):
+        word_usage_map, candidates = {}, {}
+        corrections = 0
+        
+        while True:
+            scored_results = self._score_with_tokens(
+                user_tokens, action_verb_stem, active_modules, word_usage_map, candidates
+            )
+            if scored_results or corrections >= 2:
+                break
+            
+            # No direct matches: substitute the first word with a synonym match
+            # and rescore the same pool; only the new word's usage needs counting
+            all_valid_tokens, valid_stems = self.get_valid_tokens(active_modules)
             
-            # Check each unmatched word for synonyms
+            new_tokens = None
             for word in user_tokens:
-                synonym_match = self.find_synonym_matches(word, all_valid_tokens)
-                if synonym_match:
-                    corrected_text = text.lower().replace(word, synonym_match)
-                    return self.process(corrected_text)
+                synonym_match = self.find_synonym_matches(word, all_valid_tokens, valid_stems)
+                if synonym_match and synonym_match != word:
+                    new_tokens = [synonym_match if w == word else w for w in user_tokens]
+                    break
             
+            if new_tokens is None:
+                break
+            
+            user_tokens = new_tokens
+            action_verb_stem = _find_action_verb(user_tokens)
+            corrections += 1
+        
+        if not scored_results:
             return "I'm not sure I understand. Could you rephrase that?"
         
         # Pick best match (avoid recent repeats)
-        scored_results.sort(key=lambda x: x['score'], reverse=True)
+        # At least one of the top len(recent)+1 results is not a recent
+        # repeat, so there's no need to sort the rest
+        top_results = heapq.nlargest(
+            len(self._recent_set) + 1, scored_results, key=lambda x: x['score']
+        )
         
-        best_result = scored_results[0]
+        best_result = top_results[0]
         
         if len(scored_results) > 1:
-            for candidate in scored_results:
-                entry_id = str(candidate['entry'])
-                
-                if entry_id not in self.recent_command_ids:
+            for candidate in top_results:
+                if candidate['entry']["_id"] not in self._recent_set:
                     best_result = candidate
                     break
         
-        entry_id = str(best_result['entry'])
-        self.recent_command_ids.append(entry_id)
-        if len(self.recent_command_ids) > 5:
-            self.recent_command_ids.pop(0)
+        entry = best_result['entry']
+        self.remember_command(entry["_id"])
+        
+        subject = self.extract_subject(
+            user_tokens, best_result['matched_tokens'], best_result['last_match_index']
+        )
+        
+        if selection_key is not None and corrections == 0 and len(candidates) == 1:
+            self._selection_cache[selection_key] = (entry, subject)
+            if len(self._selection_cache) > Config.SELECTION_CACHE_SIZE:
+                self._selection_cache.popitem(last=False)
         
-        # Extract subject and format response
-        subject = self.extract_subject(user_tokens, best_result['matched_tokens'])
+        return self.respond(entry, subject)
+    
+    def remember_command(self, entry_id):
+        # A limit of 0 turns repeat avoidance off
+        if not self.recent_command_ids.maxlen:
+            return
         
-        response = best_result['entry'].get("resp", "I'm not sure how to respond.")
-        response = response.replace("{subject}", subject)
-        response = response.replace("{name}", self.name)
-        response = response.replace("{username}", self.username)
+        evicted_id = None
+        if len(self.recent_command_ids) == self.recent_command_ids.maxlen:
+            evicted_id = self.recent_command_ids[0]
+        
+        self.recent_command_ids.append(entry_id)
+        self._recent_set.add(entry_id)
+        if evicted_id is not None and evicted_id not in self.recent_command_ids:
+            self._recent_set.discard(evicted_id)
+    
+    def respond(self, entry, subject):
+        response = entry["_resp_template"].format_map({
+            "subject": subject,
+            "name": self.name,
+            "username": self.username
+        })
         
         # Execute command if present
-        cmd = best_result['entry'].get("cmd")
+        cmd = entry.get("cmd")
         if cmd:
             return self.execute_command(response, cmd, subject)
         
         return response
     
+    def register_command(self, name, func):
+        """Make func(subject) available to knowledge entries as call:<name>"""
+        self._cmd_registry[name] = func
+    
     def execute_command(self, text, cmd, subject):
         if not cmd:
             return text
@@ -342,15 +674,26 @@ class IsaacCore:
             webbrowser.open(url)
             return f"{text} [Opening in browser]"
         
+        if cmd.startswith("call:"):
+            name = cmd[len("call:"):].strip()
+            func = self._cmd_registry.get(name)
+            if func is None:
+                return f"{text} [Error: unknown command '{name}']"
+            
+            try:
+                return f"{text} {func(subject)}"
+            except Exception as e:
+                return f"{text} [Error: {e}]"
+        
         if cmd.startswith("py:"):
             try:
                 code = cmd.replace("py:", "").strip()
-                result = eval(code, {
-                    "datetime": datetime,
-                    "subject": subject,
-                    "random": random,
-                    "time": time
-                })
+                code_obj = self._compiled_cmds.get(code)
+                if code_obj is None:
+                    code_obj = compile(code, "<isaac-cmd>", "eval")
+                    self._compiled_cmds[code] = code_obj
+                
+                result = eval(code_obj, _PY_GLOBALS, {"subject": subject})
                 return f"{text} {result}"
             except Exception as e:
                 return f"{text} [Error: {e}]"
@@ -358,13 +701,11 @@ class IsaacCore:
         return text
     
     def get_stats(self):
-        available_modules = set(self.module_bridge.values())
-        existing_modules = []
-        
-        for module_file in available_modules:
-            module_path = os.path.join(self.brain_dir, module_file)
-            if os.path.exists(module_path):
-                existing_modules.append(module_file)
+        available_modules = dict.fromkeys(self.module_bridge.values())
+        existing_modules = [
+            module_file for module_file in available_modules
+            if os.path.exists(os.path.join(self.brain_dir, module_file))
+        ]
         
         return {
             'core_knowledge_count': len(self.core_knowledge),
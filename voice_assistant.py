@@ -4,12 +4,16 @@ ISAAC Voice Assistant
 Voice-activated interface for ISAAC Core.
 """
 
+import array
 import asyncio
+import io
+import math
 import os
-import time
-import glob
+import re
 import sys
+import time
 import warnings
+import wave
 
 try:
     import edge_tts
@@ -24,11 +28,10 @@ except ImportError:
     sys.exit(1)
 
 try:
-    import winsound
-    HAS_WINSOUND = True
+    import pocketsphinx
+    HAS_POCKETSPHINX = True
 except ImportError:
-    HAS_WINSOUND = False
-    print("Warning: winsound not available (Windows only). Beeps disabled.")
+    HAS_POCKETSPHINX = False
 
 warnings.filterwarnings("ignore", category=UserWarning, module='pygame.pkgdata')
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -44,7 +47,10 @@ from isaac_core import IsaacCore
 
 class VoiceConfig:
     WAKE_WORDS = ["computer", "isaac"]
+    WAKE_WORD_SENSITIVITY = 0.8
     TTS_VOICE = "en-US-AndrewNeural"
+    TTS_SAMPLE_RATE = 24000
+    PLAYBACK_POLL_INTERVAL = 0.02
     
     ENERGY_THRESHOLD = 300
     PAUSE_THRESHOLD = 1.0
@@ -52,6 +58,7 @@ class VoiceConfig:
     NON_SPEAKING_DURATION = 0.5
     
     AMBIENT_CALIBRATION = 1.5
+    RECALIBRATION_INTERVAL = 300
     WAKE_WORD_TIME_LIMIT = 10
     COMMAND_TIMEOUT = 8
     COMMAND_TIME_LIMIT = 15
@@ -60,38 +67,71 @@ class VoiceConfig:
     BEEP_DURATION = 100
 
 class SpeechSystem:
-    def __init__(self, base_dir):
-        self.base_dir = base_dir
-        pygame.mixer.init()
+    def __init__(self):
+        # Match edge-tts output (24kHz mono) so SDL doesn't resample each utterance
+        pygame.mixer.init(frequency=VoiceConfig.TTS_SAMPLE_RATE, channels=1)
+        self._beep = self._make_beep()
     
-    async def speak(self, text):
+    def _make_beep(self):
+        # SDL may open the device at another rate/format than requested, so
+        # build the sine at the real rate and let pygame convert the WAV
+        rate = pygame.mixer.get_init()[0]
+        samples = rate * VoiceConfig.BEEP_DURATION // 1000
+        step = 2 * math.pi * VoiceConfig.BEEP_FREQUENCY / rate
+        frames = array.array("h", (int(12000 * math.sin(step * i)) for i in range(samples)))
+        if sys.byteorder == "big":
+            frames.byteswap()
+        
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(rate)
+            wav.writeframes(frames.tobytes())
+        
+        buffer.seek(0)
+        return pygame.mixer.Sound(file=buffer)
+    
+    def beep(self):
+        self._beep.play()
+    
+    async def synthesize(self, text):
+        """Get the mp3 audio for text as an in-memory buffer, or None"""
         if not text.strip():
-            return
+            return None
+        
+        try:
+            buffer = io.BytesIO()
+            async for chunk in edge_tts.Communicate(text, VoiceConfig.TTS_VOICE).stream():
+                if chunk["type"] == "audio":
+                    buffer.write(chunk["data"])
+        except Exception as e:
+            print(f"Speech error: {e}")
+            return None
+        
+        if not buffer.tell():
+            return None
         
-        filename = os.path.join(self.base_dir, f"speech_{int(time.time() * 1000)}.mp3")
+        buffer.seek(0)
+        return buffer
+    
+    async def play(self, audio):
+        if audio is None:
+            return
         
         try:
-            await edge_tts.Communicate(text, VoiceConfig.TTS_VOICE).save(filename)
-            pygame.mixer.music.load(filename)
+            pygame.mixer.music.load(audio, "mp3")
             pygame.mixer.music.play()
             
             while pygame.mixer.music.get_busy():
-                await asyncio.sleep(0.1)
+                await asyncio.sleep(VoiceConfig.PLAYBACK_POLL_INTERVAL)
             
             pygame.mixer.music.unload()
-            await asyncio.sleep(0.2)
-            
-            if os.path.exists(filename):
-                os.remove(filename)
         except Exception as e:
             print(f"Speech error: {e}")
     
-    def cleanup(self):
-        for file in glob.glob(os.path.join(self.base_dir, "speech_*.mp3")):
-            try:
-                os.remove(file)
-            except:
-                pass
+    async def speak(self, text):
+        await self.play(await self.synthesize(text))
     
     def shutdown(self):
         pygame.mixer.quit()
@@ -106,12 +146,24 @@ class VoiceRecognizer:
         self.recognizer.pause_threshold = VoiceConfig.PAUSE_THRESHOLD
         self.recognizer.phrase_threshold = VoiceConfig.PHRASE_THRESHOLD
         self.recognizer.non_speaking_duration = VoiceConfig.NON_SPEAKING_DURATION
+        
+        self.wake_pattern = re.compile("|".join(re.escape(wake) for wake in VoiceConfig.WAKE_WORDS))
+        self.wake_keywords = [(wake, VoiceConfig.WAKE_WORD_SENSITIVITY) for wake in VoiceConfig.WAKE_WORDS]
+        self.use_sphinx = HAS_POCKETSPHINX
+        self.last_calibration = None
     
     def calibrate(self, source):
         self.recognizer.adjust_for_ambient_noise(
             source, 
             duration=VoiceConfig.AMBIENT_CALIBRATION
         )
+        self.last_calibration = time.monotonic()
+    
+    def needs_calibration(self):
+        # dynamic_energy_threshold tracks drift between full recalibrations
+        if self.last_calibration is None:
+            return True
+        return time.monotonic() - self.last_calibration > VoiceConfig.RECALIBRATION_INTERVAL
     
     def listen_for_wake_word(self, source):
         audio = self.recognizer.listen(
@@ -119,9 +171,20 @@ class VoiceRecognizer:
             timeout=None, 
             phrase_time_limit=VoiceConfig.WAKE_WORD_TIME_LIMIT
         )
-        text = self.recognizer.recognize_google(audio).lower()
+        # Spot wake words offline when possible; only commands go to Google
+        text = None
+        if self.use_sphinx:
+            try:
+                text = self.recognizer.recognize_sphinx(audio, keyword_entries=self.wake_keywords)
+            except sr.RequestError as e:
+                # Installed but unusable (version mismatch, missing models)
+                print(f"Warning: offline wake word detection unavailable ({e}). Using Google.")
+                self.use_sphinx = False
+        
+        if text is None:
+            text = self.recognizer.recognize_google(audio)
         
-        return any(wake in text for wake in VoiceConfig.WAKE_WORDS)
+        return self.wake_pattern.search(text.lower()) is not None
     
     def listen_for_command(self, source):
         audio = self.recognizer.listen(
@@ -162,11 +225,9 @@ async def main():
     brain_dir = os.path.join(base_dir, "braindata")
     
     isaac = IsaacCore(brain_dir)
-    speech = SpeechSystem(base_dir)
+    speech = SpeechSystem()
     voice = VoiceRecognizer()
     
-    speech.cleanup()
-    
     stats = isaac.get_stats()
     print_banner(stats)
     
@@ -177,14 +238,13 @@ async def main():
     while True:
         with voice.microphone as source:
             try:
-                voice.calibrate(source)
+                if voice.needs_calibration():
+                    voice.calibrate(source)
                 
                 if voice.listen_for_wake_word(source):
-                    if HAS_WINSOUND:
-                        winsound.Beep(
-                            VoiceConfig.BEEP_FREQUENCY, 
-                            VoiceConfig.BEEP_DURATION
-                        )
+                    # Let the beep finish so the mic doesn't record it
+                    speech.beep()
+                    await asyncio.sleep(VoiceConfig.BEEP_DURATION / 1000)
                     
                     command_text = voice.listen_for_command(source)
                     